@@ -2,14 +2,25 @@ import aiohttp
 import argparse
 import asyncio
 from dataclasses import dataclass
-import json
 from hashlib import sha256
+import inspect
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import os
+from queue import SimpleQueue
 import random
+import socket
 import sys
+import tempfile
 import uuid
 
+# uvloop is optional, when it is installed it replaces the default asyncio
+# event loop with its faster libuv based one.
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 # `SenderConfig` holds the many parameters that control the behavior of the
 # sender application.
 @dataclass
@@ -21,8 +32,31 @@ class SenderConfig:
     inject_bad_checksums: bool
 
 
+# Size of the socket send buffer, big enough to hold the largest blob so that it
+# can be handed to the kernel in one go.
+SOCKET_BUFFER_SIZE = 2 * 1024 * 1024
+
+
+# Creates the sockets used for connections to the server from the address info
+# aiohttp is connecting to. Nagle's algorithm is disabled so requests are never
+# held back waiting for ACKs, and the send buffer is made big enough for a
+# whole blob.
+def create_socket(addr_info):
+    family, type_, proto, _, _ = addr_info
+    sock = socket.socket(family=family, type=type_, proto=proto)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    return sock
+
+
 # `RandomBlobProvider` is an iterable object that will provide a fixed number
-# of randomly generated binary blobs with random sizes.
+# of random binary blobs with random sizes, along with their SHA256 checksums.
+#
+# Rather than generating fresh random data for every blob, a single pool of
+# random data twice the maximum blob size is generated up front, and each blob
+# is a read-only view of a random window into it. This avoids allocating and
+# filling a new buffer of up to `max_size` bytes per blob. The pool is never
+# modified, so blobs that are still being sent can safely share it.
 class RandomBlobProvider:
     # Constructor which configures the quantity and size of random blobs
     # generated. It will generate `N` blobs in the range [`min_size`,
@@ -32,6 +66,7 @@ class RandomBlobProvider:
         self.N = N
         self.min_size = min_size
         self.max_size = max_size
+        self.pool = memoryview(os.urandom(2 * max_size))
 
     # Iteration start method, we reset the count so that it can be reused in
     # multiple loops.
@@ -39,121 +74,207 @@ class RandomBlobProvider:
         self.count = 0
         return self
 
-    # Next item method, actually generates the blob and returns it, stopping
-    # after `N` times.
+    # Next item method, generates the next blob, stopping after `N` times.
     def __next__(self):
         self.count += 1
         if self.count > self.N:
             raise StopIteration
+        return self.generate()
+
+    # Actually picks a blob out of the pool and returns it along with its hex
+    # checksum. This doesn't touch the iteration count, so it is safe to call
+    # from several threads at once.
+    def generate(self):
         size = random.randrange(self.min_size, self.max_size)
-        blob = os.urandom(size)
-        return blob
+        start = random.randrange(0, self.max_size)
+        blob = self.pool[start:start + size]
+        return blob, sha256(blob).hexdigest()
+
+
+# The multipart/form-data body of every upload has the same structure, a single
+# `bin_file` part holding the blob, so the boundary and the framing around the
+# blob are built once up front rather than through `aiohttp.FormData` on every
+# request. The boundary is random so it can't plausibly appear in the blob.
+MULTIPART_BOUNDARY = 'qci-' + uuid.uuid4().hex
+MULTIPART_CONTENT_TYPE = 'multipart/form-data; boundary=' + MULTIPART_BOUNDARY
+MULTIPART_HEAD = (
+    '--' + MULTIPART_BOUNDARY + '\r\n'
+    'Content-Disposition: form-data; name="bin_file"; filename="{filename}"\r\n'
+    'Content-Type: application/octet-stream\r\n'
+    '\r\n'
+)
+MULTIPART_TAIL = ('\r\n--' + MULTIPART_BOUNDARY + '--\r\n').encode()
+
+
+# Yields the pieces of the multipart body for uploading `blob` one after
+# another, so the blob is written to the connection as is rather than being
+# copied into one big concatenated body.
+async def multipart_body(head, blob):
+    yield head
+    yield blob
+    yield MULTIPART_TAIL
+
+
+# The process umask, read once at startup since it can only be read by setting
+# it, which isn't safe once other threads are running.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+# Writes the blob to a file at `path`. Where supported, it is written to an
+# unnamed O_TMPFILE file in the same directory that is only linked into place
+# once complete, so a partially written file is never visible and no directory
+# entry is created up front. Otherwise, or if the file can't be linked (e.g. the
+# filesystem doesn't allow it), it is written to a named temporary file that is
+# renamed into place instead. This is blocking, so it is meant to be run in a
+# thread rather than directly in a coroutine.
+def write_blob_file(path, blob):
+    try:
+        fd = os.open(os.path.dirname(path) or '.', os.O_TMPFILE | os.O_WRONLY, 0o644)
+    except (AttributeError, OSError):
+        fd = None
+    if fd is not None:
+        with open(fd, 'wb') as f:
+            f.write(blob)
+            f.flush()
+            try:
+                os.link(f'/proc/self/fd/{fd}', path)
+                return
+            except OSError:
+                pass
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    try:
+        with open(fd, 'wb') as f:
+            os.fchmod(fd, 0o644 & ~UMASK)
+            f.write(blob)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
 
 
 # Process and send one blob. The blob will be saved to a file, and then sent to
-# the server along with some metadata.
-async def send_blob(name, blob, config):
+# the server along with some metadata, including its precomputed `checksum`,
+# using the shared client `session`.
+async def send_blob(name, blob, checksum, config, session):
     # Generate a unique ID for it to pass to the server and ensure unique
-    # filenames, as well as compute the checksum.
+    # filenames.
     new_id = str(uuid.uuid4())
-    checksum = sha256(blob).hexdigest()
 
-    # Optionally corrupt the file with a 10% chance to demonstrate server
-    # checksum verification. Converting to bytearray unfortunately makes a copy
-    # of the blob, but they are only 1MB max, so not a problem for now.
+    # Optionally corrupt the checksum with a 10% chance to demonstrate server
+    # checksum verification. The blob itself is shared with the pool it came
+    # from, so flip a bit of the checksum instead of modifying it.
     if config.inject_bad_checksums and random.random() < 0.1:
-        logging.info(f'{name} intentionally corrupting blob')
-        blob = bytearray(blob)
-        blob[0] += 1
+        logging.info('%s intentionally corrupting checksum', name)
+        checksum = format(int(checksum[0], 16) ^ 1, 'x') + checksum[1:]
 
-    # Write the blob to a file synchronously, blocking the coroutine until
-    # done.
+    # Start writing the blob to a file in a separate thread so that the
+    # coroutine isn't blocked on disk I/O, and let it run while the request is
+    # in flight.
     filename = 'sender-' + new_id + '.bin'
     path = os.path.join(config.save_dir, filename)
-    with open(path, 'wb') as f:
-        f.write(blob)
-        logging.info(f'{name} wrote binary file to {path}')
-
-    # Send file and metadata to the server as multipart/form-data in a POST
-    blob_file = open(path, 'rb')
-    blob_metadata = {'id': new_id, 'hash': checksum}
-    form_data = aiohttp.FormData()
-    form_data.add_field('metadata', json.dumps(blob_metadata))
-    form_data.add_field('bin_file', blob_file)
-    async with aiohttp.ClientSession() as session:
-        async with session.post(config.url, data=form_data) as response:
+    write_task = asyncio.create_task(asyncio.to_thread(write_blob_file, path, blob))
+
+    # Send the in-memory blob to the server as multipart/form-data in a POST,
+    # no need to read it back from the file. The metadata is sent in headers so
+    # the server can check it before reading the body.
+    head = MULTIPART_HEAD.format(filename=filename).encode()
+    headers = {
+        'X-Blob-Id': new_id,
+        'X-Blob-Hash': checksum,
+        'Content-Type': MULTIPART_CONTENT_TYPE,
+        'Content-Length': str(len(head) + len(blob) + len(MULTIPART_TAIL)),
+    }
+    body = multipart_body(head, blob)
+    try:
+        async with session.post(config.url, data=body, headers=headers) as response:
             if response.status == 200:
                 j = await response.json()
                 msg = j['message']
-                logging.info(f'{name} successfully sent blob and received response {msg}')
+                logging.info('%s successfully sent blob and received response %s', name, msg)
             else:
-                logging.info(f'{name} encountered status {response.status} sending blob')
+                logging.info('%s encountered status %d sending blob', name, response.status)
+    finally:
+        # Make sure the file has been completely written before moving on, even
+        # if sending it failed.
+        await write_task
+        logging.info('%s wrote binary file to %s', name, path)
 
 
-# The send worker task runs indefinitely until cancelled, processing one blob
-# from the queue at a time.
-async def send_worker(name, queue, config):
-    try:
-        while True:
-            blob = await queue.get()
-            await asyncio.shield(send_blob(name, blob, config))
-            queue.task_done()
-    except asyncio.CancelledError:
-        logging.info(f'{name} done!')
+# Sends one blob like `send_blob`, but first waits on `semaphore` so that only a
+# limited number of blobs are ever being sent at the same time.
+async def send_blob_limited(semaphore, name, blob, checksum, config, session):
+    async with semaphore:
+        await send_blob(name, blob, checksum, config, session)
 
 
-# The generate worker will generate the blobs and put them in the queue, with a
-# random sleep between them.
-async def generate_worker(num_files, queue):
+# Generates the blobs, yielding each one along with its checksum, with a random
+# sleep between them. Blobs are generated and hashed in threads, up to one per
+# CPU at a time, so that generation keeps ahead of the sends and the event loop
+# is free to run them in the meantime. Blobs are yielded in the order they
+# finish generating.
+async def generate_blobs(num_files):
     blob_provider = RandomBlobProvider(min_size=1024, max_size=1024*1024, N=num_files)
-    for blob in blob_provider:
-        logging.info(f'Generated new blob of length {len(blob)}')
-        await queue.put(blob)
+    semaphore = asyncio.Semaphore(os.cpu_count() or 1)
+
+    async def generate_one():
+        async with semaphore:
+            return await asyncio.to_thread(blob_provider.generate)
+
+    for next_blob in asyncio.as_completed([generate_one() for _ in range(num_files)]):
+        blob, checksum = await next_blob
+        logging.info('Generated new blob of length %d', len(blob))
+        yield blob, checksum
         sleep_time = random.uniform(0.001, 1.0)
         await asyncio.sleep(sleep_time)
-    logging.info(f'Generator task done!')
+    logging.info('Generator task done!')
 
 
-# The application handles generating and sending random files using a single
-# data generator task and a multiple worker tasks that communicate via a queue.
+# The application handles generating and sending random files, starting a send
+# task for each blob as soon as it has been generated.
 #
-# The data generator task generates randomly sized blobs at random time
-# intervals and enqueues them. Once the generator task has completed, the
-# application will begin the shutdown process, described below.
+# Randomly sized blobs are generated at random time intervals. Each send task
+# handles saving its blob to a file, and sending it to the server via HTTP. A
+# semaphore limits the number of blobs being sent at once to the configured
+# number of workers, with the rest waiting their turn.
 #
-# The worker tasks handle saving the blobs to files, and sending them to the
-# server via HTTP. The worker tasks run forever, handling new blobs in the
-# queue, until the shutdown process begins.
+# All sends share a single HTTP client session, so connections to the server
+# are pooled and kept alive between requests instead of being reestablished for
+# every blob. The pool is sized to allow one connection per worker.
 #
-# Shutdown is handled by waiting for the queue to be empty after the generation
-# task is done. Once the send workers have taken all blobs from the queue and
-# marked them as done, we raise a cancelled exception in each send worker task,
-# which they will catch and take a hint to exit gracefully.
+# Once every blob has been generated, shutdown is just waiting for all of the
+# send tasks to finish with a `gather`.
 async def main(config):
-    # Create a queue to send the random blobs to the workers, and an event to
-    # coordinate cancellation.
-    queue = asyncio.Queue(maxsize=config.num_files)
-
-    # Create the worker tasks, keeping track of the task objects for later when
-    # we need to wait on them during shudown
-    loop = asyncio.get_running_loop()
-    send_tasks = []
-    for i in range(config.num_workers):
-        t = loop.create_task(send_worker(f'W{i}', queue, config))
-        send_tasks.append(t)
-
-    # Now create the data generator task and run the loop until it is
-    # completed. Once it is done, every blob that we're going to make has been
-    # put in the queue. Once they've been emplaced in the queue, we can wait
-    # for the queue to be empty with a `join()` to guarantee that they have all
-    # been processed.
-    await generate_worker(config.num_files, queue)
-    await queue.join()
-
-    # Gracefully terminate all the send workers.
-    for t in send_tasks:
-        t.cancel()
-        await t
+    # Create the shared client session, with a connection pool large enough
+    # for every concurrent send to have its own keep-alive connection to the
+    # server.
+    # The connections use sockets from `create_socket`, except on versions of
+    # aiohttp before 3.12 that don't support a socket factory yet.
+    connector_args = {
+        'limit': config.num_workers,
+        'limit_per_host': config.num_workers,
+    }
+    if 'socket_factory' in inspect.signature(aiohttp.TCPConnector).parameters:
+        connector_args['socket_factory'] = create_socket
+    connector = aiohttp.TCPConnector(**connector_args)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        # Start sending each blob as it is generated, keeping track of the
+        # tasks so we can wait on them before the session is closed.
+        semaphore = asyncio.Semaphore(config.num_workers)
+        send_tasks = []
+        names = []
+        async for blob, checksum in generate_blobs(config.num_files):
+            name = f'B{len(send_tasks)}'
+            coro = send_blob_limited(semaphore, name, blob, checksum, config, session)
+            send_tasks.append(asyncio.create_task(coro))
+            names.append(name)
+
+        # Wait for all of the sends to finish, logging any that failed rather
+        # than letting one failure abandon the rest.
+        results = await asyncio.gather(*send_tasks, return_exceptions=True)
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                logging.error('%s failed to send blob: %r', name, result)
     logging.info('Done!')
 
 
@@ -166,7 +287,7 @@ if __name__ == '__main__':
     parser.add_argument('-n', '--num_files', action='store', default='100', type=int,
                         help='Number of random binary files to generate')
     parser.add_argument('-w', '--num_workers', action='store', default='10', type=int,
-                        help='Number of concurrent send workers')
+                        help='Maximum number of blobs to send concurrently')
     parser.add_argument('-f', '--logfile', action='store',
                         help='Optional file to log to')
     parser.add_argument('-d', '--binfile_dir', action='store', default='/tmp',
@@ -195,6 +316,14 @@ if __name__ == '__main__':
         stream_handler.setFormatter(formatter)
         logger.addHandler(stream_handler)
 
+    # The handlers do blocking I/O, so rather than having the send workers call
+    # them directly, log records are put on a queue and handed to the handlers
+    # by a background listener thread.
+    log_queue = SimpleQueue()
+    log_listener = QueueListener(log_queue, *logger.handlers)
+    logger.handlers = [QueueHandler(log_queue)]
+    log_listener.start()
+
     # To keep the parameter lists from getting out of hand, bundle all options
     # into a config object and then pass it to the main send logic.
     url = f'http://{args.address}:{args.port}/uploads'
@@ -205,4 +334,10 @@ if __name__ == '__main__':
         save_dir = args.binfile_dir,
         inject_bad_checksums = args.inject_bad_checksums,
     )
-    asyncio.run(main(config))
+    # Use the faster uvloop event loop when it is available.
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    try:
+        asyncio.run(main(config))
+    finally:
+        log_listener.stop()
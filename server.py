@@ -1,91 +1,269 @@
 import argparse
-from aiohttp import web
+import asyncio
+from aiohttp import BodyPartReader, web
 from hashlib import sha256
-import json
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import os
+from queue import SimpleQueue
+import shutil
+import signal
+import socket
 import sys
+import tempfile
+import traceback
 
+# The `cryptography` package is optional, it is only used to verify checksums
+# when hashlib isn't backed by OpenSSL.
+try:
+    from cryptography.hazmat.primitives import hashes
+except ImportError:
+    hashes = None
 
-# Checks that the hash of the provided blob matches the provided hash.
-def verify_checksum(checksum, blob):
-    new_checksum = sha256(blob).hexdigest()
-    return checksum == new_checksum
+# uvloop is optional, when it is installed it replaces the default asyncio
+# event loop with its faster libuv based one.
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 
-# Checks that metadata contains the required fields, logging an error and
-# return false if not.
-def validate_upload_metadata(j):
-    if 'id' not in j:
-        logging.error(f'Malformed request, no id in metadata {j}')
-        return False
-    if 'hash' not in j:
-        logging.error(f'Malformed request, no hash metadata in {j}')
-        return False
-    return True
+# Reports whether the CPU advertises the SHA extensions (SHA-NI) by looking for
+# the `sha_ni` flag in /proc/cpuinfo. Returns false if that can't be read.
+def cpu_has_sha_ni():
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('flags') and 'sha_ni' in line.split():
+                    return True
+    except OSError:
+        pass
+    return False
+
+
+# Minimal hashlib-style wrapper around the SHA256 from `cryptography`, which is
+# always bound to a recent OpenSSL that uses SHA-NI when the CPU has it.
+class CryptographySHA256:
+    def __init__(self):
+        self.hash = hashes.Hash(hashes.SHA256())
+
+    def update(self, data):
+        self.hash.update(data)
+
+    def hexdigest(self):
+        return self.hash.finalize().hex()
+
+
+# Picks the SHA256 implementation used to verify checksums. When hashlib is
+# backed by OpenSSL it already uses SHA-NI if available, so it is used as is.
+# Otherwise hashlib falls back to a much slower portable implementation, so
+# prefer `cryptography` if it is installed and the CPU has SHA-NI.
+def select_sha256():
+    if sha256.__name__ == 'openssl_sha256':
+        return sha256
+    if hashes is not None and cpu_has_sha_ni():
+        return CryptographySHA256
+    return sha256
+
+
+# SHA256 implementation to use for checksum verification, selected once at
+# startup.
+SHA256 = select_sha256()
+
+
+# The process umask, read once at startup since it can only be read by setting
+# it, which isn't safe once other threads are running.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+# Creates a uniquely named temporary file in `directory`, returning its open
+# file descriptor and path. Its permissions are the O_TMPFILE files' 0644 with
+# the umask applied, rather than the owner-only ones `mkstemp` uses.
+def create_temp_file(directory):
+    fd, path = tempfile.mkstemp(dir=directory)
+    try:
+        os.fchmod(fd, 0o644 & ~UMASK)
+    except OSError:
+        os.close(fd)
+        os.remove(path)
+        raise
+    return fd, path
+
+
+# `AtomicFile` is a new file opened for writing that only appears at its final
+# `path` once `commit` is called, so partially written or rejected uploads are
+# never visible there. Where supported, it is an unnamed O_TMPFILE file in the
+# destination directory that gets linked into place on commit, which also
+# skips creating a directory entry up front. Otherwise it falls back to a named
+# temporary file that is renamed into place.
+class AtomicFile:
+    # Constructor which opens the unnamed (or temporary) file next to `path`.
+    # This is blocking, so it is meant to be run in a thread.
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path) or '.'
+        try:
+            fd = os.open(directory, os.O_TMPFILE | os.O_RDWR, 0o644)
+            self.tmp_path = None
+        except (AttributeError, OSError):
+            fd, self.tmp_path = create_temp_file(directory)
+        self.file = open(fd, 'w+b')
+
+    # Writes `data` to the file.
+    def write(self, data):
+        self.file.write(data)
+
+    # Finishes writing the file and gives it its final name, replacing any
+    # existing file with the same name. This is blocking, so it is meant to be
+    # run in a thread.
+    def commit(self):
+        self.file.flush()
+        if self.tmp_path is not None:
+            os.replace(self.tmp_path, self.path)
+            self.tmp_path = None
+        else:
+            try:
+                os.link(f'/proc/self/fd/{self.file.fileno()}', self.path)
+            except OSError:
+                # Linking fails if the name is already taken, and some
+                # filesystems support O_TMPFILE but can't link the file in at
+                # all, so copy the contents to a named temporary file instead
+                # and rename that into place. It is recorded in `tmp_path`
+                # first so `close` cleans it up if anything fails.
+                fd, self.tmp_path = create_temp_file(os.path.dirname(self.path) or '.')
+                self.file.seek(0)
+                with open(fd, 'wb') as out:
+                    shutil.copyfileobj(self.file, out)
+                os.replace(self.tmp_path, self.path)
+                self.tmp_path = None
+        self.file.close()
+
+    # Closes the file, throwing it away if it was never committed. This is
+    # blocking, so it is meant to be run in a thread.
+    def close(self):
+        self.file.close()
+        if self.tmp_path is not None:
+            os.remove(self.tmp_path)
+            self.tmp_path = None
+
 
+# Size of the chunks that uploaded files are read, hashed and written in.
+CHUNK_SIZE = 64 * 1024
 
-# Checks that post request form data contains the required metadata and binary
-# file.
-def validate_post(data):
-    if not 'bin_file' in data:
-        logging.error(f'Malformed request, no bin_file in {data.keys()}')
+
+# Writes one chunk of an uploaded file to `f`, also feeding it to `hasher` if
+# one is given. This is blocking, so it is meant to be run in a thread.
+def write_chunk(f, hasher, chunk):
+    f.write(chunk)
+    if hasher is not None:
+        hasher.update(chunk)
+
+
+# Streams the uploaded file `part` into `blob_file` as it arrives from the
+# network, `CHUNK_SIZE` bytes at a time, and returns the number of bytes
+# written. Each chunk is hashed with `hasher` (if given) right after it is
+# written, so the whole upload is never held in memory and is only passed over
+# once. Raises `HTTPRequestEntityTooLarge` as soon as the file grows past
+# `max_size` bytes, so an oversized upload is never read in full.
+async def save_blob_part(part, blob_file, hasher, max_size):
+    size = 0
+    while chunk := await part.read_chunk(CHUNK_SIZE):
+        size += len(chunk)
+        if size > max_size:
+            logging.error('Upload exceeds the %d byte limit, rejecting it', max_size)
+            raise web.HTTPRequestEntityTooLarge(max_size=max_size, actual_size=size)
+        await asyncio.to_thread(write_chunk, blob_file, hasher, chunk)
+    return size
+
+
+# Checks that the request headers contain the required metadata, logging an
+# error and return false if not.
+def validate_upload_headers(headers):
+    if 'X-Blob-Id' not in headers:
+        logging.error('Malformed request, no X-Blob-Id in headers %s', headers.keys())
         return False
-    if not 'metadata' in data:
-        logging.error(f'Malformed request, no metadata in {data.keys()}')
+    if 'X-Blob-Hash' not in headers:
+        logging.error('Malformed request, no X-Blob-Hash in headers %s', headers.keys())
         return False
     return True
 
 
-# The upload handler handles POST requests with a binary file and metadata,
-# saving the recieved binary file to the configured save_dir and optionally
-# checking its integrity using the provided hash as a checksum.
+# The upload handler handles POST requests with a binary file, and metadata in
+# the `X-Blob-Id` and `X-Blob-Hash` headers, saving the recieved binary file to
+# the configured save_dir and optionally checking its integrity using the
+# provided hash as a checksum. The file is streamed straight to disk as it is
+# received rather than buffering the whole request first.
 #
 # If required metadata or file data is missing, it will return 400
 #
 # If handled successfully, it will return status 200 with a JSON payload
 # containing a friendly message to confirm reciept.
 async def upload_handler(request):
-    # Parse and validate POST request.
-    data = await request.post()
-    if not validate_post(data):
+    # Extract the id and checksum from the headers. These are checked before
+    # the body is read, so malformed requests are rejected without reading it.
+    if not validate_upload_headers(request.headers):
         return web.Response(status=400)
-
-    # Extract binary blob from POST request. We read the entire file into
-    # memory since they are at most 1MB and therefore not too large to handle
-    # several at a time.
-    blob = data['bin_file'].file.read()
-
-    # Extract the id and checksum from JSON body.
-    metadata = json.loads(data['metadata'])
-    if not validate_upload_metadata(metadata):
-        return web.Response(status=400)
-    content_id = metadata['id']
-    content_hash = metadata['hash']
-
-    # Ensure contents match provided checksum, not because we ever expect
-    # this to be corrupted, but because it is cool and the whole point of
-    # this application is to write a bunch of cool code to see what kind of
-    # stuff myenik writes.
-    if request.app['config']['verify_hash'] and not verify_checksum(content_hash, blob):
-        logging.error('Strict hash checking enabled, but hashes dont match!')
-        logging.info('Saving file will be skipped due to hash mismatch!')
+    content_id = request.headers['X-Blob-Id']
+    content_hash = request.headers['X-Blob-Hash']
+    if request.content_type != 'multipart/form-data':
+        logging.error('Malformed request, unexpected content type %s', request.content_type)
         return web.Response(status=400)
 
-    # Save the file contents to the configured location.
+    # Hash the contents while saving them if checksums are being verified.
+    hasher = SHA256() if request.app['config']['verify_hash'] else None
+
+    # Save the file contents to the configured location as the parts of the
+    # multipart POST body arrive, skipping any parts other than the file. The
+    # file only shows up under its name once it has been accepted. Its size is
+    # capped by the app's `client_max_size`, like `request.post()` would.
     filename = 'server-' + content_id + '.bin'
     path = os.path.join(request.app['config']['uploads_dir'], filename)
-    with open(path, 'wb') as f:
-        f.write(blob)
-        logging.info(f'Wrote a {len(blob)} byte file to {path}')
+    blob_file = await asyncio.to_thread(AtomicFile, path)
+    try:
+        size = None
+        reader = await request.multipart()
+        while (part := await reader.next()) is not None:
+            if not isinstance(part, BodyPartReader) or part.name != 'bin_file':
+                await part.release()
+                continue
+            if size is not None:
+                logging.error('Malformed request, more than one bin_file in POST body')
+                return web.Response(status=400)
+            size = await save_blob_part(part, blob_file, hasher, request.client_max_size)
+        if size is None:
+            logging.error('Malformed request, no bin_file in POST body')
+            return web.Response(status=400)
+
+        # Ensure contents match provided checksum, not because we ever expect
+        # this to be corrupted, but because it is cool and the whole point of
+        # this application is to write a bunch of cool code to see what kind of
+        # stuff myenik writes.
+        if hasher is not None and hasher.hexdigest() != content_hash:
+            logging.error('Strict hash checking enabled, but hashes dont match!')
+            logging.info('Saving file will be skipped due to hash mismatch!')
+            return web.Response(status=400)
+        await asyncio.to_thread(blob_file.commit)
+    finally:
+        await asyncio.to_thread(blob_file.close)
+    logging.info('Wrote a %d byte file to %s', size, path)
 
     # Return friendly message with included length to verify reciept of file.
     response = {
-        'message': f'Successfully received the {len(blob)} byte file',
+        'message': f'Successfully received the {size} byte file',
     }
     return web.json_response(response)
 
 
+# Runs the app's log listener thread for as long as the app is running. It is
+# started here rather than up front so that each worker process gets its own
+# listener thread, since threads don't survive a fork.
+async def run_log_listener(app):
+    app['log_listener'].start()
+    yield
+    app['log_listener'].stop()
+
+
 # Creates aiohttp Application object with only one route, a POST handler for
 # our file uploads.
 def create_app(config={}):
@@ -95,6 +273,94 @@ def create_app(config={}):
     return app
 
 
+# Size of the socket send and receive buffers, big enough to hold the largest
+# upload so that it can be received in one go.
+SOCKET_BUFFER_SIZE = 2 * 1024 * 1024
+
+
+# Creates the listening sockets for the server, one for each address that
+# `host` and `port` resolve to (e.g. both IPv4 and IPv6 for "localhost"). The
+# accepted connections inherit their options, so this is where Nagle's
+# algorithm is disabled and the socket buffers are made big enough for a whole
+# upload. With `reuse_port`, several processes can each bind their own sockets
+# to the same port.
+def create_server_sockets(host, port, reuse_port=False):
+    sockets = []
+    try:
+        for family, type_, proto, _, addr in socket.getaddrinfo(
+                host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE):
+            sock = socket.socket(family=family, type=type_, proto=proto)
+            sockets.append(sock)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            # Keep IPv6 sockets from also claiming the port for IPv4, which
+            # would clash with the IPv4 sockets bound alongside them.
+            if family == socket.AF_INET6:
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+            sock.bind(addr)
+    except OSError:
+        for sock in sockets:
+            sock.close()
+        raise
+    return sockets
+
+
+# Runs the server in `num_workers` forked worker processes that all listen on
+# the same port with SO_REUSEPORT, so the kernel spreads incoming connections
+# across them and uploads are handled on several cores at once. The parent just
+# waits for the workers, passing along an interrupt to shut them all down.
+# Returns true only if every worker exited successfully.
+def run_worker_processes(app, host, port, num_workers):
+    pids = []
+    for i in range(num_workers):
+        pid = os.fork()
+        if pid == 0:
+            # The worker always leaves through `os._exit`, so an error never
+            # unwinds into the parent's code below.
+            exit_code = 1
+            try:
+                # Only the first worker prints the startup banner.
+                sockets = create_server_sockets(host, port, reuse_port=True)
+                web.run_app(app, sock=sockets, access_log=None,
+                            print=print if i == 0 else None)
+                exit_code = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exit_code)
+        pids.append(pid)
+
+    # Forward interrupts to the workers so they all shut down gracefully, then
+    # wait for them to exit. The handlers are installed explicitly since SIGINT
+    # may be ignored, e.g. when started in the background from a script.
+    def forward_signal(signum, frame):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGINT, forward_signal)
+    signal.signal(signal.SIGTERM, forward_signal)
+    # All workers are forked by now, so the parent can run its own log
+    # listener to report on them.
+    app['log_listener'].start()
+    success = True
+    for pid in pids:
+        _, status = os.waitpid(pid, 0)
+        exit_code = os.waitstatus_to_exitcode(status)
+        if exit_code != 0:
+            logging.error('Worker %d exited with status %d', pid, exit_code)
+            success = False
+    app['log_listener'].stop()
+    return success
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-a', '--address', action='store', default='127.0.0.1',
@@ -105,6 +371,8 @@ if __name__ == '__main__':
                         help='Optional file to log to')
     parser.add_argument('-d', '--uploads_dir', action='store', default='/tmp',
                         help='Directory to store uploaded binary files')
+    parser.add_argument('-w', '--num_workers', action='store', default='1', type=int,
+                        help='Number of server worker processes sharing the port')
     parser.add_argument('--disable-stdout-logging', action='store_true',
                         help='Disable logging to stdout')
     parser.add_argument('--disable-checksum-verification', action='store_true',
@@ -129,11 +397,31 @@ if __name__ == '__main__':
         stream_handler.setFormatter(formatter)
         logger.addHandler(stream_handler)
 
+    logging.info('Verifying checksums using %s', SHA256.__name__)
+
+    # Once the server is running, the handlers' blocking I/O is kept out of the
+    # request handlers. Log records are put on a queue instead, and handed to
+    # the handlers by a listener thread that runs alongside the app.
+    log_queue = SimpleQueue()
+    log_listener = QueueListener(log_queue, *logger.handlers)
+    logger.handlers = [QueueHandler(log_queue)]
+
     # Finally run the server! Passing `access_log=None` disables some noisy
-    # INFO-level logging built in to aiohttp.
+    # INFO-level logging built in to aiohttp. With more than one worker, the
+    # server is run in that many processes instead.
     config = {
         'uploads_dir': args.uploads_dir,
         'verify_hash': not args.disable_checksum_verification,
     }
+    # Use the faster uvloop event loop when it is available.
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     app = create_app(config)
-    web.run_app(app, host=args.address, port=args.port, access_log=None)
+    app['log_listener'] = log_listener
+    app.cleanup_ctx.append(run_log_listener)
+    if args.num_workers > 1:
+        if not run_worker_processes(app, args.address, args.port, args.num_workers):
+            exit(1)
+    else:
+        sockets = create_server_sockets(args.address, args.port)
+        web.run_app(app, sock=sockets, access_log=None)